@@ -34,24 +34,29 @@ ELSE:
         - push operator and bundle images (if they exist)
 """
 
-from typing import List, Iterable, TypeVar
+from typing import Dict, List, Iterable, Optional, Tuple
 import click
+import copy
 import sys
-import yaml
-import subprocess
+import selectors
+import signal
 import shlex
+import shutil
 import os
 import os.path
 import platform
+from pathlib import Path
 import logging
-import logging.handlers
-from operator_sdk_manager.update import operator_sdk_update
 
 
 if platform.system() != "Linux":
     raise RuntimeError("operate.py is designed only for Linux.")
 
-T = TypeVar("Operator")
+# Whether the default syslog socket exists, checked once at import
+_SYSLOG_AVAILABLE = os.path.exists('/dev/log')
+
+# Parsed settings files and their modification time, keyed on absolute path
+_YAML_CACHE: Dict[str, Tuple[int, dict]] = {}
 
 
 class Operator(object):
@@ -62,53 +67,53 @@ class Operator(object):
     to manage your operator project.
     """
     osdk_config = {
-        "osdk_path": os.path.join(
+        "osdk_path": Path(
             os.environ["HOME"], ".local", "bin", "operator-sdk"
         ),
         "osdk_url": ("https://github.com/operator-framework/operator-sdk/"
                      "releases/download/v"),
     }
+    osdk_dir = os.fspath(osdk_config["osdk_path"].parent)
+    _logger_configured = False
+    _stderr_handler = None
+    _cached_runtime: Optional[str] = None
 
     def __init__(self, image: str = None, version: str = None,
-                 channels: List[str] = [], kinds: List[str] = [],
+                 channels: List[str] = None, kinds: List[str] = None,
                  default_sample: str = None, domain: str = None,
                  group: str = None, api_version: str = None,
                  initialized: bool = False, verbosity: int = None) -> None:
         self.image = image
         self.version = version
-        self.channels = channels
-        self.kinds = kinds
+        self.channels = channels if channels is not None else []
+        self.kinds = kinds if kinds is not None else []
         self.default_sample = default_sample
         self.domain = domain
         self.group = group
         self.api_version = api_version
+        self.initialized = initialized
         self.runtime = self._determine_runtime()
         self.logger = self.get_logger(verbosity=verbosity)
 
     def __repr__(self) -> str:
-        return ("OperatorSettings(image={}, version={}, channels={}, kinds={},"
-                " default_sample={}, domain={}, group={}, api_version={},"
-                " initialized={})").format(
-            self.image,
-            self.version,
-            self.channels,
-            self.kinds,
-            self.sample,
-            self.domain,
-            self.group,
-            self.api_version,
-            self.initialized
-        )
+        return (f"OperatorSettings(image={self.image},"
+                f" version={self.version}, channels={self.channels},"
+                f" kinds={self.kinds}, default_sample={self.default_sample},"
+                f" domain={self.domain}, group={self.group},"
+                f" api_version={self.api_version},"
+                f" initialized={self.initialized})")
 
-    def get_logger(self, verbosity: int = None) -> logging.Logger:
+    @classmethod
+    def get_logger(cls, verbosity: int = None) -> logging.Logger:
         """
         Creates a logger in a dynamic way, allowing us to call it multiple
         times if needed and only creating it once.
         """
         logger = logging.getLogger('Operator')
-        logger.setLevel(logging.DEBUG)
 
-        if len(logger.handlers) == 0:
+        if not Operator._logger_configured:
+            logger.setLevel(logging.DEBUG)
+
             # A well-parsable format
             _format = '{asctime} {name} [{levelname:^9s}]: {message}'
             formatter = logging.Formatter(_format, style='{')
@@ -123,32 +128,50 @@ class Operator(object):
                 # Use WARNING level verbosity
                 stderr.setLevel(40)
             logger.addHandler(stderr)
+            Operator._stderr_handler = stderr
 
-            if os.path.exists('/dev/log'):
+            if _SYSLOG_AVAILABLE:
                 # Use the default syslog socket at INFO level
-                syslog = logging.handlers.SysLogHandler(address='/dev/log')
+                from logging.handlers import SysLogHandler
+                syslog = SysLogHandler(address='/dev/log')
                 syslog.setFormatter(formatter)
                 syslog.setLevel(logging.INFO)
                 logger.addHandler(syslog)
 
+            Operator._logger_configured = True
+
         elif verbosity is not None:
             # We may have already created the logger, but without specifying
-            #   verbosity. So here, we grab the stderr handler and set its
-            #   verbosity level.
-            stderr = logger.handlers[0]
-            stderr.setLevel(40 - (min(3, verbosity) * 10))
+            #   verbosity. So here, we set the level on the stderr handler we
+            #   kept from that first call.
+            Operator._stderr_handler.setLevel(40 - (min(3, verbosity) * 10))
 
         return logger
 
     @classmethod
-    def load(cls, file: str = "operate.yml") -> T:
+    def load(cls, file: str = "operate.yml") -> "Operator":
         """
         Alternate constructor that lods the necessary operator settings from a
         properly structured yaml file.
         """
+        import yaml
+        try:
+            # Prefer the libyaml-backed loader when PyYAML was built with it
+            from yaml import CSafeLoader as SafeLoader
+        except ImportError:
+            from yaml import SafeLoader
+
         logger = cls.get_logger()
-        with open(file) as f:
-            settings = yaml.safe_load(f)
+        path = os.path.abspath(file)
+        mtime = os.stat(path).st_mtime_ns
+        cached = _YAML_CACHE.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path, "rb") as f:
+                cached = _YAML_CACHE[path] = (
+                    mtime, yaml.load(f, Loader=SafeLoader)
+                )
+        # Each Operator gets its own copy to mutate
+        settings = copy.deepcopy(cached[1])
         logger.debug("Recovered settings:")
         logger.debug(settings)
 
@@ -170,27 +193,140 @@ class Operator(object):
         return line_bytes.decode("utf-8").rstrip()
 
     @classmethod
-    def shell(cls, cmd: str = None, fail: bool = True) -> Iterable[str]:
+    def _spawn(cls, argv: List[str] = None,
+               file_actions: list = None) -> int:
         """
-        Runs a command in a subprocess, yielding lines of output from it and
-        optionally failing with its non-zero return code.
+        Spawns a command with the given posix_spawn file actions, returning
+        its pid. posix_spawn avoids the fork+exec overhead of
+        subprocess.Popen. argv is executed directly and never parsed by a
+        shell, so its values need no quoting. The command leads its own
+        process group so that _kill can reach anything it starts.
         """
         logger = cls.get_logger()
-        logger.debug("Running: {}".format(cmd))
-        proc = subprocess.Popen(shlex.split(cmd),
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT)
+        logger.debug("Running: {}".format(shlex.join(argv)))
+        return os.posix_spawnp(argv[0], argv, os.environ,
+                               file_actions=file_actions, setpgroup=0)
 
-        for line in map(cls._utf8ify, iter(proc.stdout.readline, b'')):
-            logger.debug("Line:    {}".format(line))
-            yield line
+    @staticmethod
+    def _kill(pid: int = None) -> None:
+        """
+        Kills a spawned command's whole process group and reaps the command,
+        for when we stop waiting on it before it finishes.
+        """
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        os.waitpid(pid, 0)
 
-        ret = proc.wait()
+    @classmethod
+    def _wait(cls, pid: int = None, argv: List[str] = None,
+              fail: bool = True, stderr: bytes = b'') -> int:
+        """
+        Waits on a spawned command, optionally failing with its non-zero
+        return code, and otherwise returning it. Any captured stderr is logged
+        if the command failed.
+        """
+        logger = cls.get_logger()
+        ret = os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+        if ret != 0:
+            log = logger.error if fail else logger.warning
+            for line in map(cls._utf8ify, stderr.splitlines()):
+                log("Stderr:  {}".format(line))
         if fail and ret != 0:
-            logger.error("Command errored: {}".format(cmd))
+            logger.error("Command errored: {}".format(shlex.join(argv)))
             exit(ret)
         elif ret != 0:
-            logger.warning("Command returned {}: {}".format(ret, cmd))
+            logger.warning("Command returned {}: {}".format(
+                ret, shlex.join(argv)
+            ))
+        return ret
+
+    @classmethod
+    def shell(cls, argv: List[str] = None,
+              fail: bool = True) -> Iterable[str]:
+        """
+        Runs a command in a subprocess, yielding lines of output from it and
+        optionally failing with its non-zero return code. stdout is logged at
+        DEBUG and stderr at WARNING.
+        """
+        logger = cls.get_logger()
+        out_r, out_w = os.pipe2(os.O_CLOEXEC)
+        err_r, err_w = os.pipe2(os.O_CLOEXEC)
+        try:
+            pid = cls._spawn(argv, file_actions=[
+                (os.POSIX_SPAWN_DUP2, out_w, 1),
+                (os.POSIX_SPAWN_DUP2, err_w, 2),
+            ])
+        except BaseException:
+            os.close(out_r)
+            os.close(err_r)
+            raise
+        finally:
+            os.close(out_w)
+            os.close(err_w)
+
+        # Partial trailing lines, and how to log complete ones, per stream
+        partials = {out_r: b'', err_r: b''}
+        logs = {
+            out_r: lambda line: logger.debug("Line:    {}".format(line)),
+            err_r: lambda line: logger.warning("Stderr:  {}".format(line)),
+        }
+        selector = selectors.DefaultSelector()
+        finished = False
+        try:
+            for fd in partials:
+                selector.register(fd, selectors.EVENT_READ)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    chunk = os.read(key.fd, 65536)
+                    if not chunk:
+                        selector.unregister(key.fd)
+                        lines = [partials[key.fd]] if partials[key.fd] else []
+                    else:
+                        lines = (partials[key.fd] + chunk).split(b'\n')
+                        partials[key.fd] = lines.pop()
+                    for line in map(cls._utf8ify, lines):
+                        logs[key.fd](line)
+                        yield line
+            finished = True
+        finally:
+            selector.close()
+            os.close(out_r)
+            os.close(err_r)
+            if not finished:
+                # The caller stopped reading early, so stop and reap the
+                #   command rather than leaving it or its children behind
+                cls._kill(pid)
+
+        cls._wait(pid, argv, fail=fail)
+
+    @classmethod
+    def run(cls, argv: List[str] = None, fail: bool = True) -> int:
+        """
+        Runs a command in a subprocess to completion with its stdout discarded,
+        optionally failing with its non-zero return code, and otherwise
+        returning it. stderr is collected and logged if the command fails.
+        """
+        r, w = os.pipe2(os.O_CLOEXEC)
+        try:
+            pid = cls._spawn(argv, file_actions=[
+                (os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+                (os.POSIX_SPAWN_DUP2, w, 2),
+            ])
+        except BaseException:
+            os.close(r)
+            raise
+        finally:
+            os.close(w)
+
+        try:
+            with os.fdopen(r, "rb") as stderr:
+                errors = stderr.read()
+        except BaseException:
+            cls._kill(pid)
+            raise
+        return cls._wait(pid, argv, fail=fail, stderr=errors)
 
     def _install_operator_sdk(self, version: str = "latest") -> None:
         """
@@ -198,9 +334,11 @@ class Operator(object):
         in the configured osdk_path with a version identifier postpended, and
         symlinks into place.
         """
+        from operator_sdk_manager.update import operator_sdk_update
+
         installed_version = operator_sdk_update(
-            directory=os.path.dirname(self.osdk_config["osdk_path"]),
-            path=os.path.dirname(self.osdk_config["osdk_path"]),
+            directory=self.osdk_dir,
+            path=self.osdk_dir,
             version=version
         )
         self.logger.info("Operator SDK version {} installed".format(
@@ -211,16 +349,25 @@ class Operator(object):
     def _determine_runtime(cls) -> str:
         """
         Determine the container runtime that should be used to build operator
-        images.
+        images. The result is cached for the life of the process.
         """
-        for line in cls.shell("which docker", fail=False):
-            if line.endswith("/docker") and not os.path.islink(line):
-                return "docker"
-        for line in cls.shell("which podman", fail=False):
-            if line.endswith("/podman") and not os.path.islink(line):
-                return "podman"
+        if Operator._cached_runtime is not None:
+            return Operator._cached_runtime
+        for runtime in ("docker", "podman"):
+            path = shutil.which(runtime)
+            if path is not None and not os.path.islink(path):
+                Operator._cached_runtime = runtime
+                return runtime
         raise RuntimeError("Unable to identify a container runtime!")
 
+    @classmethod
+    def set_runtime(cls, runtime: Optional[str] = None) -> None:
+        """
+        Overrides the cached container runtime, or clears it with None so the
+        next Operator detects it again.
+        """
+        Operator._cached_runtime = runtime
+
     def initialize_operator(self) -> None:
         """
         Initialize an Ansible Operator SDK operator and create the APIs
@@ -229,16 +376,18 @@ class Operator(object):
         if self.initialized:
             return
 
-        _ = self.shell(
-            "operator-sdk init --plugins=ansible --domain={}".format(
-                self.domain
-            )
-        )
-        _ = [self.shell(
-            "operator-sdk create api --group={} --version={} --kind={}".format(
-                self.group, self.version, kind
-            )
-        ) for kind in self.kinds]
+        self.run([
+            "operator-sdk", "init", "--plugins=ansible",
+            f"--domain={self.domain}",
+        ])
+        # These must stay sequential: each create api rewrites PROJECT,
+        #   watches.yaml and the kustomizations under config/, so concurrent
+        #   runs lose updates.
+        for kind in self.kinds:
+            self.run([
+                "operator-sdk", "create", "api", f"--group={self.group}",
+                f"--version={self.version}", f"--kind={kind}",
+            ])
 
         self.initialized = True
 
@@ -247,7 +396,7 @@ class Operator(object):
             build_tag = self.version
         else:
             build_tag = tag
-        self.logger.info("Building {}:{}".format(self.image, build_tag))
+        self.logger.info(f"Building {self.image}:{build_tag}")
 
 
 # We'll be using these repeatedly